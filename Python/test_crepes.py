@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 from sklearn.model_selection import train_test_split
 from crepes import WrapClassifier, WrapRegressor
@@ -9,13 +10,13 @@ dataset = pd.read_csv('../intermediate_data/ssp1.csv')
 y = dataset.pop('humanitarian').astype('str').astype('category').values
 dataset.pop('humanitarian_needs')
 
-X = dataset.values.astype(float)
+X = dataset.values.astype(np.float32) # sklearn trees split on float32, so avoid an internal copy
 
 X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2)
 
 X_prop_train, X_cal, y_prop_train, y_cal = train_test_split(X_train, y_train, test_size=0.25)
 
-rf = WrapClassifier(RandomForestClassifier(n_jobs=-1))
+rf = WrapClassifier(RandomForestClassifier(n_jobs=-1, max_features='sqrt', n_estimators=200))
 
 rf.fit(X_prop_train, y_prop_train)
 
@@ -1,3 +1,5 @@
+import csv
+from contextlib import nullcontext
 import pandas as pd
 import torch
 import torch.nn as nn
@@ -16,6 +18,16 @@ n_embd = 384
 n_head = 6
 n_layer = 6
 dropout = 0.2
+compile_blocks = device == 'cuda' # compile each transformer block with torch.compile (CUDA graphs need a GPU)
+
+if device == 'cuda':
+    # allow tf32 on matmul and cudnn
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
+# mixed precision: bfloat16 where supported, otherwise float16 with gradient scaling
+amp_dtype = torch.bfloat16 if device == 'cuda' and torch.cuda.is_bf16_supported() else torch.float16
+ctx = torch.autocast(device_type='cuda', dtype=amp_dtype) if device == 'cuda' else nullcontext()
 
 dataset = pd.read_csv('../intermediate_data/ssp1.csv')
 
@@ -42,94 +54,83 @@ def unscale_X(x):
 X = scale_X(X)
 X = np.round(X, -6).astype(int)
 
-chars = sorted(np.unique(
-    np.concatenate([
-        np.unique(X),
-        np.unique(y)
-    ])
-))
+# one hash pass over X and y gives both the sorted vocabulary and every encoded value
+codes, chars = pd.factorize(np.concatenate([X.ravel(), y]), sort=True)
+X_codes = codes[:X.size].reshape(X.shape)
+y_codes = codes[X.size:]
 vocab_size = len(chars)
 print("Vocab size: ", vocab_size)
 
-stoi = { ch:i for i,ch in enumerate(chars) }
-itos = { i:ch for i,ch in enumerate(chars) }
-encode = lambda s: [stoi[c] for c in s] # encoder: take a string, output a list of integers
-decode = lambda l: ','.join([str(itos[i]) for i in l]) # decoder: take a list of integers, output a string
-
 # Train and test splits
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.1)
-X_train_data = torch.tensor(np.apply_along_axis(encode, 1, X_train), dtype=torch.long)
-X_test_data = torch.tensor(np.apply_along_axis(encode, 1, X_test), dtype=torch.long)
-y_train_data = torch.tensor(encode(y_train), dtype=torch.long)
-y_test_data = torch.tensor(encode(y_test), dtype=torch.long)
+X_train, X_test, y_train, y_test, X_train_codes, X_test_codes, y_train_codes, y_test_codes = train_test_split(
+    X, y, X_codes, y_codes, test_size=0.1
+)
+X_train_data = torch.from_numpy(X_train_codes).long()
+X_test_data = torch.from_numpy(X_test_codes).long()
+y_train_data = torch.from_numpy(y_train_codes).long()
+y_test_data = torch.from_numpy(y_test_codes).long()
+# the encoded data is small enough to keep on the device for the whole run
+X_train_data = X_train_data.to(device)
+X_test_data = X_test_data.to(device)
+y_train_data = y_train_data.to(device)
+y_test_data = y_test_data.to(device)
 
 
 def get_batch(split):
     # generate a small batch of data of inputs x and targets y
     data = X_train_data if split == 'train' else X_test_data
     targets = y_train_data if split == 'train' else y_test_data
-    ix = torch.randint(len(data), (batch_size,))
-    x = torch.stack([data[i] for i in ix])
-    y = torch.stack([targets[i] for i in ix])
-    y.unsqueeze_(-1)
-    y = y.expand(batch_size, block_size)
-    x, y = x.to(device), y.to(device)
+    ix = torch.randint(len(data), (batch_size,), device=device)
+    x = data.index_select(0, ix)
+    y = targets.index_select(0, ix).unsqueeze(-1).expand(batch_size, block_size).contiguous()
     return x, y
 
-@torch.no_grad()
+@torch.inference_mode()
 def estimate_loss():
     out = {}
     model.eval()
     for split in ['train', 'val']:
-        losses = torch.zeros(eval_iters)
+        # accumulate on the device and synchronize once per split
+        losses = torch.zeros(eval_iters, device=device)
         for k in range(eval_iters):
             X, Y = get_batch(split)
-            logits, loss = model(X, Y)
-            losses[k] = loss.item()
-        out[split] = losses.mean()
+            with ctx:
+                logits, loss = model(X, Y)
+            losses[k] = loss.detach()
+        out[split] = losses.mean().item()
     model.train()
     return out
 
-class Head(nn.Module):
-    """ one head of self-attention """
-
-    def __init__(self, head_size):
-        super().__init__()
-        self.key = nn.Linear(n_embd, head_size, bias=False)
-        self.query = nn.Linear(n_embd, head_size, bias=False)
-        self.value = nn.Linear(n_embd, head_size, bias=False)
-        self.register_buffer('tril', torch.tril(torch.ones(block_size, block_size)))
-
-        self.dropout = nn.Dropout(dropout)
-
-    def forward(self, x):
-        # input of size (batch, time-step, channels)
-        # output of size (batch, time-step, head size)
-        B,T,C = x.shape
-        k = self.key(x)   # (B,T,hs)
-        q = self.query(x) # (B,T,hs)
-        # compute attention scores ("affinities")
-        wei = q @ k.transpose(-2,-1) * k.shape[-1]**-0.5 # (B, T, hs) @ (B, hs, T) -> (B, T, T)
-        # wei = wei.masked_fill(self.tril[:T, :T] == 0, float('-inf')) # (B, T, T)
-        wei = F.softmax(wei, dim=-1) # (B, T, T)
-        wei = self.dropout(wei)
-        # perform the weighted aggregation of the values
-        v = self.value(x) # (B,T,hs)
-        out = wei @ v # (B, T, T) @ (B, T, hs) -> (B, T, hs)
-        return out
-
 class MultiHeadAttention(nn.Module):
     """ multiple heads of self-attention in parallel """
 
     def __init__(self, num_heads, head_size):
         super().__init__()
-        self.heads = nn.ModuleList([Head(head_size) for _ in range(num_heads)])
+        self.num_heads = num_heads
+        self.head_size = head_size
+        # query, key and value projections for all heads in a single matmul
+        self.qkv = nn.Linear(n_embd, 3 * num_heads * head_size, bias=False)
         self.proj = nn.Linear(head_size * num_heads, n_embd)
-        self.dropout = nn.Dropout(dropout)
 
     def forward(self, x):
-        out = torch.cat([h(x) for h in self.heads], dim=-1)
-        out = self.dropout(self.proj(out))
+        # input of size (batch, time-step, channels)
+        # output of size (batch, time-step, channels)
+        B,T,C = x.shape
+        qkv = self.qkv(x).reshape(B, T, 3, self.num_heads, self.head_size).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2] # (B, nh, T, hs)
+        train_dropout = self.training and dropout > 0
+        # fused attention: scores, softmax, dropout and the weighted aggregation of the values
+        # in one kernel, without materializing the (B, nh, T, T) affinities
+        out = F.scaled_dot_product_attention(
+            q.contiguous(), k.contiguous(), v.contiguous(),
+            dropout_p=dropout if train_dropout else 0.0,
+            is_causal=False
+        ) # (B, nh, T, hs)
+        out = out.transpose(1, 2).reshape(B, T, C) # re-assemble all head outputs side by side
+        out = self.proj(out)
+        if train_dropout:
+            # skip the dropout call entirely at eval time
+            out = F.dropout(out, p=dropout)
         return out
 
 class FeedFoward(nn.Module):
@@ -171,7 +172,13 @@ class GPTTabularModel(nn.Module):
         # each token directly reads off the logits for the next token from a lookup table
         self.token_embedding_table = nn.Embedding(vocab_size, n_embd)
         self.position_embedding_table = nn.Embedding(block_size, n_embd)
+        self.register_buffer('pos_ids', torch.arange(block_size), persistent=False)
         self.blocks = nn.Sequential(*[Block(n_embd, n_head=n_head) for _ in range(n_layer)])
+        if compile_blocks:
+            # regional compilation: every block shares one shape, so compile them individually
+            # and leave the embeddings and lm_head in eager mode
+            for i, block in enumerate(self.blocks):
+                self.blocks[i] = torch.compile(block, mode='reduce-overhead', fullgraph=True)
         self.ln_f = nn.LayerNorm(n_embd) # final layer norm
         self.lm_head = nn.Linear(n_embd, vocab_size)
 
@@ -191,7 +198,7 @@ class GPTTabularModel(nn.Module):
 
         # idx and targets are both (B,T) tensor of integers
         tok_emb = self.token_embedding_table(idx) # (B,T,C)
-        pos_emb = self.position_embedding_table(torch.arange(T, device=device)) # (T,C)
+        pos_emb = self.position_embedding_table(self.pos_ids[:T]) # (T,C)
         x = tok_emb + pos_emb # (B,T,C)
         x = self.blocks(x) # (B,T,C)
         x = self.ln_f(x) # (B,T,C)
@@ -230,7 +237,11 @@ m = model.to(device)
 print(sum(p.numel() for p in m.parameters())/1e6, 'M parameters')
 
 # create a PyTorch optimizer
-optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
+# the fused kernel is CUDA only, the multi-tensor foreach path is the next best thing on CPU
+optimizer_args = dict(fused=True) if device == 'cuda' else dict(foreach=True)
+optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, **optimizer_args)
+# gradient scaler is a no-op unless training in float16
+scaler = torch.cuda.amp.GradScaler(enabled=(device == 'cuda' and amp_dtype == torch.float16))
 
 for iter in range(max_iters):
 
@@ -243,10 +254,12 @@ for iter in range(max_iters):
     xb, yb = get_batch('train')
 
     # evaluate the loss
-    logits, loss = model(xb, yb)
+    with ctx:
+        logits, loss = model(xb, yb)
     optimizer.zero_grad(set_to_none=True)
-    loss.backward()
-    optimizer.step()
+    scaler.scale(loss).backward()
+    scaler.step(optimizer)
+    scaler.update()
 
 # generate from the model
 header = [
@@ -271,12 +284,19 @@ header = [
     "humanitarian_needs_prediction"
 ]
 
-with open('transformer_output.csv', 'w') as csv_file:
-    csv_file.write(','.join(header) + '\n')
-    for i in range(0, len(X_test_data)):
-        actual = str(y_test[i].tolist())
-        context = X_test_data[i].expand(1, block_size)
-        row = ','.join([str(unscale_X(cell)) for cell in X_test[i].tolist()])
-        prediction = decode([m.generate(context, max_new_tokens=1)[0].tolist()[-1]])
-        row = row + ',' + actual + ',' + prediction + '\n'
-        csv_file.write(row)
+# predict the whole test set in a single batch
+contexts = X_test_data # (N, block_size)
+with torch.no_grad():
+    out = m.generate(contexts, max_new_tokens=1)
+preds = out[:, -1].cpu().numpy()
+predictions = chars[preds] # decode the whole prediction column with one gather
+
+X_test_unscaled = unscale_X(X_test) # (N, block_size), unscale_X is elementwise so apply it to the whole matrix at once
+rows = [
+    row + [actual, prediction]
+    for row, actual, prediction in zip(X_test_unscaled.tolist(), y_test.tolist(), predictions.tolist())
+]
+with open('transformer_output.csv', 'w', newline='') as csv_file:
+    writer = csv.writer(csv_file, lineterminator='\n')
+    writer.writerow(header)
+    writer.writerows(rows)